@@ -1,15 +1,27 @@
+import io
 import os
 import re
+import sys
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
 from fastapi import FastAPI, UploadFile, File
+from fastapi.responses import ORJSONResponse
 from typing import List
 from pydantic import BaseModel
 from PyPDF2 import PdfReader
 from sentence_transformers import SentenceTransformer
+import torch
 import faiss
 import tempfile
-import shutil
-import openai
+import pickle
+import aiofiles
+from openai import AsyncOpenAI
 from google import generativeai as genai
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
@@ -18,7 +30,8 @@ from fastapi.middleware.cors import CORSMiddleware
 load_dotenv()
 
 # Initialize FastAPI app
-app = FastAPI(title="DPDP Compliance Backend API")
+# orjson serializes responses (e.g. search results with large texts) much faster
+app = FastAPI(title="DPDP Compliance Backend API", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -30,53 +43,500 @@ app.add_middleware(
 )
 
 # Configure AI APIs
-openai.api_key = os.getenv("OPENAI_API_KEY")
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
+# Shared async OpenAI client so HTTP connections are pooled across requests.
+# Created on first use, since the constructor fails without an API key.
+openai_client = None
+
+def _get_openai_client():
+    global openai_client
+    if openai_client is None:
+        openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return openai_client
+
+# Int8-quantized ONNX Runtime version of the embedding model, exposing the same
+# encode() interface as SentenceTransformer. Enable with EMBEDDING_BACKEND=onnx
+# (needs onnxruntime and optimum installed).
+class OnnxEmbeddingModel:
+    def __init__(self, model_name, model_dir="onnx", max_seq_length=256):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        quantized_path = os.path.join(model_dir, 'model-int8.onnx')
+        if not os.path.exists(quantized_path):
+            self._export(model_name, model_dir, quantized_path)
+
+        self.max_seq_length = max_seq_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = os.cpu_count() or 1
+        self.session = ort.InferenceSession(quantized_path, sess_options, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        # Fail here (so the SentenceTransformer fallback kicks in) rather than
+        # on every encode if the export used different output names
+        output_names = [o.name for o in self.session.get_outputs()]
+        if 'last_hidden_state' not in output_names:
+            raise ValueError(f"{quantized_path} has no 'last_hidden_state' output (outputs: {output_names})")
+
+    @staticmethod
+    def _export(model_name, model_dir, quantized_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        print(f"Exporting {model_name} to ONNX in {model_dir}...")
+        subprocess.run(
+            ["optimum-cli", "export", "onnx", "--model", f"sentence-transformers/{model_name}",
+             "--task", "feature-extraction", model_dir],
+            check=True
+        )
+        quantize_dynamic(os.path.join(model_dir, 'model.onnx'), quantized_path, weight_type=QuantType.QInt8)
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, normalize_embeddings=False,
+               show_progress_bar=False, convert_to_tensor=False):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        outputs = []
+        for start in range(0, len(sentences), batch_size):
+            encoded = self.tokenizer(
+                sentences[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors='np'
+            )
+            feeds = {k: v.astype(np.int64) for k, v in encoded.items() if k in self.input_names}
+            last_hidden_state = self.session.run(['last_hidden_state'], feeds)[0]
+
+            # Mean-pool over real tokens, then L2-normalize (as the
+            # sentence-transformers pipeline for this model does)
+            mask = encoded['attention_mask'][..., None].astype(np.float32)
+            pooled = (last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            outputs.append(pooled.astype(np.float32))
+
+        embeddings = np.concatenate(outputs)
+        return embeddings[0] if single else embeddings
+
+# When the server is started with `python backend.py`, processes spawned by
+# multiprocessing (e.g. the SentenceTransformer encode pool) re-run this file as
+# __mp_main__. They get the model pickled from the parent, so skip loading the
+# model and building the index there.
+_IS_SPAWNED_CHILD = __name__ == "__mp_main__"
+
 # Initialize embedding model
 # Note: 'all-MiniLM-L6-v2' will be downloaded on first run
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+embedding_model = None
+if _IS_SPAWNED_CHILD:
+    pass
+elif os.getenv("EMBEDDING_BACKEND", "").lower() == "onnx":
+    try:
+        embedding_model = OnnxEmbeddingModel('all-MiniLM-L6-v2', model_dir=os.getenv("ONNX_MODEL_DIR", "onnx"))
+    except Exception as e:
+        print(f"Failed to load ONNX embedding model, falling back to SentenceTransformer: {e}")
+if embedding_model is None and not _IS_SPAWNED_CHILD:
+    embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+
+    # Use all cores for CPU inference, split between uvicorn workers so they
+    # don't oversubscribe the machine. An explicit OMP_NUM_THREADS wins.
+    if os.getenv("OMP_NUM_THREADS"):
+        torch.set_num_threads(max(1, int(os.environ["OMP_NUM_THREADS"])))
+    else:
+        uvicorn_workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // uvicorn_workers))
+    try:
+        torch.set_num_interop_threads(2)
+    except RuntimeError:
+        # Can only be set before any inter-op parallel work has started
+        pass
+    torch.backends.mkldnn.enabled = True
+    embedding_model.eval()
 
 # Initialize FAISS index
+# HNSW gives ~O(log N) approximate search instead of the exhaustive scan of a
+# flat index, and unlike IVF/PQ it needs no training pass, so vectors can still
+# be added one at a time as they arrive.
+# Vectors are L2-normalized and compared by inner product, and stored as fp16
+# to halve the index memory.
+# The IDMap wrapper keys every vector by its row in the vector store below.
+# With USE_GPU_FAISS=1 a flat fp16 index on the GPU is used instead (GPU FAISS
+# has no HNSW, and brute force on the GPU is fast anyway).
 embedding_dimension = 384
-faiss_index = faiss.IndexFlatL2(embedding_dimension)
-vector_store_texts = []
-vector_store_metadata = []
+USE_GPU_FAISS = os.getenv("USE_GPU_FAISS") == "1"
+faiss_on_gpu = False
+_gpu_resources = None
+
+def _index_to_gpu(index):
+    global _gpu_resources
+    try:
+        if _gpu_resources is None:
+            _gpu_resources = faiss.StandardGpuResources()
+        options = faiss.GpuClonerOptions()
+        options.useFloat16 = True
+        return faiss.index_cpu_to_gpu(_gpu_resources, 0, index, options)
+    except Exception as e:
+        print(f"GPU FAISS unavailable, using CPU index: {e}")
+        return None
+
+def _build_index():
+    global faiss_on_gpu
+
+    if USE_GPU_FAISS:
+        gpu_index = _index_to_gpu(faiss.IndexIDMap(faiss.IndexFlatIP(embedding_dimension)))
+        if gpu_index is not None:
+            faiss_on_gpu = True
+            return gpu_index
+
+    hnsw_index = faiss.index_factory(embedding_dimension, "HNSW32,SQfp16", faiss.METRIC_INNER_PRODUCT)
+    hnsw_index.hnsw.efConstruction = 100
+    hnsw_index.hnsw.efSearch = 64
+    return faiss.IndexIDMap(hnsw_index)
+
+faiss_index = None if _IS_SPAWNED_CHILD else _build_index()
+
+# Reusable float32 staging buffers for single-vector adds and queries, so the
+# hot paths don't allocate (and cast) a fresh (1, 384) array per request.
+# Safe to share: they are filled and consumed without yielding the event loop.
+_STAGE1 = np.empty((1, embedding_dimension), dtype=np.float32)
+_STAGE1_ID = np.empty(1, dtype=np.int64)
+_QUERY_STAGE1 = np.empty((1, embedding_dimension), dtype=np.float32)
+
+# Vector store: texts and metadata live in NumPy object arrays whose row i is
+# FAISS id i, so search results are gathered with a single fancy index.
+# Arrays grow geometrically; only the first vector_store_size rows are in use.
+vector_store_size = 0
+vector_store_texts = np.empty(0, dtype=object)
+vector_store_metadata = np.empty(0, dtype=object)
+
+def _object_array(items):
+    arr = np.empty(len(items), dtype=object)
+    arr[:] = items
+    return arr
+
+def _store_append(texts, metadatas):
+    global vector_store_size, vector_store_texts, vector_store_metadata, vector_store_dirty
+
+    start = vector_store_size
+    end = start + len(texts)
+    if end > len(vector_store_texts):
+        capacity = max(end, 2 * len(vector_store_texts), 1024)
+        grown_texts = np.empty(capacity, dtype=object)
+        grown_texts[:start] = vector_store_texts[:start]
+        grown_metadata = np.empty(capacity, dtype=object)
+        grown_metadata[:start] = vector_store_metadata[:start]
+        vector_store_texts, vector_store_metadata = grown_texts, grown_metadata
+
+    vector_store_texts[start:end] = _object_array(texts)
+    vector_store_metadata[start:end] = _object_array(metadatas)
+    vector_store_size = end
+    vector_store_dirty = True
+
+# On-disk copy of the vector store, so restarts don't require re-ingesting
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", "store")
+VECTOR_INDEX_FILE = VECTOR_STORE_PATH + ".faiss"
+VECTOR_META_FILE = VECTOR_STORE_PATH + ".meta"
+# True when the in-memory store has changes not yet written to disk
+vector_store_dirty = False
+# Documents ingested into the store: document_name -> (path, mtime, size) of
+# the file that was ingested, persisted with the store so re-running ingest
+# after a restart doesn't add the same chunks again
+ingested_documents = {}
+# Set when existing store files failed to load and couldn't be moved aside;
+# saving is then refused so they aren't replaced with the in-memory store
+vector_store_load_failed = False
+
+def _move_aside_vector_store():
+    # Keep unreadable store files as *.corrupt so later saves can't destroy them
+    global vector_store_load_failed
+
+    try:
+        for path in (VECTOR_INDEX_FILE, VECTOR_META_FILE):
+            if os.path.exists(path):
+                os.replace(path, path + ".corrupt")
+        print(f"Moved unreadable vector store files to {VECTOR_STORE_PATH}.*.corrupt")
+    except OSError as e:
+        print(f"Error moving unreadable vector store files aside: {e}")
+        vector_store_load_failed = True
+
+def _make_temp_path(path):
+    # Unique per call, so several uvicorn workers saving at once don't
+    # write into the same temp file
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path) + ".",
+        suffix=".tmp"
+    )
+    os.close(fd)
+    return tmp_path
+
+def _save_vector_store():
+    global vector_store_dirty
+
+    if vector_store_load_failed:
+        raise RuntimeError(f"existing files at {VECTOR_STORE_PATH} failed to load and were not moved aside")
+
+    # Write to temp files first so a crash mid-write can't corrupt the store.
+    # GPU indexes can't be serialized directly, so write a CPU copy.
+    cpu_index = faiss.index_gpu_to_cpu(faiss_index) if faiss_on_gpu else faiss_index
+    index_tmp = _make_temp_path(VECTOR_INDEX_FILE)
+    meta_tmp = _make_temp_path(VECTOR_META_FILE)
+    try:
+        faiss.write_index(cpu_index, index_tmp)
+        with open(meta_tmp, "wb") as f:
+            pickle.dump(
+                (vector_store_texts[:vector_store_size], vector_store_metadata[:vector_store_size], ingested_documents),
+                f
+            )
+        os.replace(index_tmp, VECTOR_INDEX_FILE)
+        os.replace(meta_tmp, VECTOR_META_FILE)
+    finally:
+        for tmp_path in (index_tmp, meta_tmp):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    vector_store_dirty = False
+
+# Multi-process encoding for large batches (e.g. ingesting the DPDP Act).
+# The pool is started on the first batch big enough to use it, so servers that
+# never see one don't hold extra model copies. Set EMBEDDING_POOL_SIZE=0 to disable.
+EMBEDDING_POOL_SIZE = int(os.getenv("EMBEDDING_POOL_SIZE", min(4, os.cpu_count() or 1)))
+# Below this many texts the IPC overhead outweighs the extra processes
+EMBEDDING_POOL_MIN_TEXTS = 256
+embedding_pool = None
+_embedding_pool_lock = threading.Lock()
+
+def _get_embedding_pool():
+    global embedding_pool
+
+    if EMBEDDING_POOL_SIZE < 2 or not isinstance(embedding_model, SentenceTransformer):
+        return None
+    with _embedding_pool_lock:
+        if embedding_pool is None:
+            # Split the cores between the pool processes: each child inherits
+            # OMP_NUM_THREADS, which torch uses as its thread count
+            previous = os.environ.get("OMP_NUM_THREADS")
+            os.environ["OMP_NUM_THREADS"] = str(max(1, (os.cpu_count() or 1) // EMBEDDING_POOL_SIZE))
+            try:
+                embedding_pool = embedding_model.start_multi_process_pool(target_devices=['cpu'] * EMBEDDING_POOL_SIZE)
+            finally:
+                if previous is None:
+                    del os.environ["OMP_NUM_THREADS"]
+                else:
+                    os.environ["OMP_NUM_THREADS"] = previous
+    return embedding_pool
+
+def _encode_texts(texts):
+    use_pool = len(texts) >= EMBEDDING_POOL_MIN_TEXTS and _get_embedding_pool() is not None
+
+    # Smart batching: SentenceTransformer.encode sorts by length only within a
+    # single call, so for the pool (which splits the list into chunks) and the
+    # ONNX backend sort here, so each batch pads to a similar length, and then
+    # restore the original order
+    if use_pool or not isinstance(embedding_model, SentenceTransformer):
+        order = np.argsort([len(t) for t in texts], kind='stable')
+        embeddings = _encode_in_order([texts[i] for i in order], use_pool)
+        return embeddings[np.argsort(order)]
+
+    return _encode_in_order(texts, use_pool)
+
+def _encode_in_order(texts, use_pool):
+    if use_pool:
+        return embedding_model.encode_multi_process(texts, embedding_pool, batch_size=32, chunk_size=64)
+
+    with torch.inference_mode():
+        return embedding_model.encode(
+            texts,
+            batch_size=64,
+            convert_to_numpy=True,
+            normalize_embeddings=False,
+            show_progress_bar=False
+        )
+
+# In-process LRU cache of embeddings, keyed by a digest of the text so repeated
+# queries/chunks skip the transformer forward pass
+EMBEDDING_CACHE_SIZE = 4096
+_embedding_cache = OrderedDict()
+# Encoding also runs in worker threads (see _EmbeddingBatcher)
+_embedding_cache_lock = threading.Lock()
+
+def _text_key(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+def _get_cached_embedding(text):
+    key = _text_key(text)
+    with _embedding_cache_lock:
+        embedding = _embedding_cache.get(key)
+        if embedding is not None:
+            _embedding_cache.move_to_end(key)
+    return embedding
+
+def _encode_batch(texts):
+    keys = [_text_key(t) for t in texts]
+    # Hits are copied out here: another thread may evict them while we encode
+    found = {}
+    missing = {}
+    with _embedding_cache_lock:
+        for key, text in zip(keys, texts):
+            embedding = _embedding_cache.get(key)
+            if embedding is not None:
+                _embedding_cache.move_to_end(key)
+                found[key] = embedding
+            else:
+                missing.setdefault(key, text)
+
+    # Encode all cache misses in one call
+    if missing:
+        embeddings = _encode_texts(list(missing.values())).astype('float32', copy=False)
+        embeddings.setflags(write=False)
+    else:
+        embeddings = []
+
+    fresh = dict(zip(missing, embeddings))
+    found.update(fresh)
+    result = np.stack([found[key] for key in keys])
+
+    with _embedding_cache_lock:
+        for key, embedding in fresh.items():
+            _embedding_cache[key] = embedding
+            _embedding_cache.move_to_end(key)
+        while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+            _embedding_cache.popitem(last=False)
+    return result
+
+# Dynamic batching: concurrent single-text requests are queued for a short
+# window and encoded together in one forward pass, off the event loop
+class _EmbeddingBatcher:
+    def __init__(self, batch_size=32, timeout_ms=10):
+        self.batch_size = batch_size
+        self.timeout = timeout_ms / 1000
+        self._queue = None
+        self._worker = None
+
+    async def embed(self, text):
+        embedding = _get_cached_embedding(text)
+        if embedding is not None:
+            return embedding
+
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.qsize() < self.batch_size - 1:
+                # Give concurrent requests a moment to join this batch
+                await asyncio.sleep(self.timeout)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            try:
+                embeddings = await asyncio.to_thread(_encode_batch, [text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+embedder = _EmbeddingBatcher(batch_size=32, timeout_ms=10)
+
+_WS_RE = re.compile(r'\s+')
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+
+# PDFs with at least this many pages have their text extracted in parallel
+PARALLEL_PDF_MIN_PAGES = 32
+PARALLEL_PDF_MAX_WORKERS = 4
+PDF_EXTRACT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdf_extract.py')
+
+# Each page range is extracted by a fresh interpreter running pdf_extract.py,
+# which imports only PyPDF2. A multiprocessing pool would instead re-import
+# this module (and load the embedding model) in every worker on platforms
+# that start processes with spawn, such as Windows and macOS.
+def _extract_page_range(args):
+    pdf_path, start, stop = args
+    result = subprocess.run(
+        [sys.executable, PDF_EXTRACT_SCRIPT, pdf_path, str(start), str(stop)],
+        capture_output=True,
+        check=True
+    )
+    return result.stdout.decode('utf-8')
+
+# Helper function for PDF text extraction
+def _extract_pdf_text(pdf_path):
+    reader = PdfReader(pdf_path)
+    num_pages = len(reader.pages)
+    workers = min(os.cpu_count() or 1, PARALLEL_PDF_MAX_WORKERS, num_pages)
+
+    if num_pages < PARALLEL_PDF_MIN_PAGES or workers < 2:
+        buf = io.StringIO()
+        for page in reader.pages:
+            page_text = page.extract_text()
+            if page_text:
+                buf.write(page_text)
+        return buf.getvalue()
+
+    # One contiguous page range per process, so each worker parses the PDF once.
+    # The threads only wait on the worker processes.
+    step = -(-num_pages // workers)
+    ranges = [(pdf_path, start, min(start + step, num_pages)) for start in range(0, num_pages, step)]
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        return "".join(executor.map(_extract_page_range, ranges))
 
 # Helper function for PDF text extraction and chunking
 def get_pdf_text_and_chunk(pdf_path, chunk_size=500, overlap=50):
-    text = ""
     try:
-        reader = PdfReader(pdf_path)
-        for page in reader.pages:
-            text += page.extract_text() or ""
+        text = _extract_pdf_text(pdf_path)
     except Exception as e:
         print(f"Error reading PDF: {e}")
         return []
 
-    text = re.sub(r'\s+', ' ', text).strip()
+    text = _WS_RE.sub(' ', text).strip()
     chunks = []
-    current_chunk = ""
-    sentences = re.split(r'(?<=[.!?])\s+', text)
-
-    for sentence in sentences:
-        if len(current_chunk) + len(sentence) + 1 <= chunk_size:
-            current_chunk += (sentence + " ")
-        else:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = sentence + " "
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-
+    # Collect sentences and join once per chunk instead of growing a string
+    current_parts: list[str] = []
+    current_len = 0
+
+    for sentence in _SENT_RE.split(text):
+        slen = len(sentence) + 1
+        if current_len + slen > chunk_size and current_parts:
+            chunks.append(" ".join(current_parts))
+            current_parts, current_len = [], 0
+        current_parts.append(sentence)
+        current_len += slen
+    if current_parts:
+        chunks.append(" ".join(current_parts))
+
+    # One shared (interned) name string for every chunk of the document
+    document_name = sys.intern(os.path.basename(pdf_path))
     processed_chunks = []
     for i, chunk_text in enumerate(chunks):
         processed_chunks.append({
             "text": chunk_text,
-            "metadata": {"document_name": os.path.basename(pdf_path), "chunk_id": i}
+            "metadata": {"document_name": document_name, "chunk_id": i}
         })
     return processed_chunks
 
+# Memoized chunking keyed on (absolute path, mtime, size), so re-ingesting an
+# unchanged PDF skips extraction and sentence splitting entirely.
+# Failures raise instead of returning, since lru_cache doesn't cache
+# exceptions and a transient error shouldn't stick for the unchanged file.
+@lru_cache(maxsize=32)
+def _chunk_pdf(path_key, chunk_size=500, overlap=50):
+    pdf_path = path_key[0]
+    chunks = tuple(get_pdf_text_and_chunk(pdf_path, chunk_size=chunk_size, overlap=overlap))
+    if not chunks:
+        raise ValueError(f"No chunks extracted from {pdf_path}")
+    return chunks
+
 # Pydantic models for request bodies
 class TextChunk(BaseModel):
     text: str
@@ -91,6 +551,65 @@ class ChatRequest(BaseModel):
     model: str  # "chatgpt" or "gemini"
     history: List[dict] = []
 
+# Load / save the vector store across restarts
+@app.on_event("startup")
+async def load_vector_store():
+    global faiss_index, faiss_on_gpu, vector_store_size, vector_store_texts, vector_store_metadata
+    global ingested_documents
+
+    if os.path.exists(VECTOR_INDEX_FILE) and os.path.exists(VECTOR_META_FILE):
+        try:
+            index = faiss.read_index(VECTOR_INDEX_FILE)
+            with open(VECTOR_META_FILE, "rb") as f:
+                stored = pickle.load(f)
+            texts, metadata = stored[0], stored[1]
+            if len(stored) > 2:
+                documents = stored[2]
+            else:
+                # Older store files don't record ingested documents
+                documents = {
+                    m["document_name"]: None
+                    for m in metadata if isinstance(m, dict) and "document_name" in m
+                }
+            # The two files are replaced separately, so a crash between the
+            # replaces can leave them out of sync; ids would then be reused
+            if not index.ntotal == len(texts) == len(metadata):
+                raise ValueError(
+                    f"index has {index.ntotal} vectors but metadata has {len(texts)} texts / {len(metadata)} entries"
+                )
+        except Exception as e:
+            print(f"Error loading vector store from {VECTOR_STORE_PATH}: {e}")
+            _move_aside_vector_store()
+            return
+        faiss_on_gpu = False
+        if USE_GPU_FAISS:
+            gpu_index = _index_to_gpu(index)
+            if gpu_index is not None:
+                index, faiss_on_gpu = gpu_index, True
+        faiss_index = index
+        vector_store_texts, vector_store_metadata = _object_array(texts), _object_array(metadata)
+        vector_store_size = len(vector_store_texts)
+        ingested_documents = documents
+        print(f"Loaded {faiss_index.ntotal} vectors from {VECTOR_INDEX_FILE}")
+
+@app.on_event("shutdown")
+async def save_vector_store():
+    if not vector_store_dirty:
+        return
+    try:
+        _save_vector_store()
+    except Exception as e:
+        print(f"Error saving vector store to {VECTOR_STORE_PATH}: {e}")
+
+# Stop the multi-process encoding pool, if it was started
+@app.on_event("shutdown")
+async def stop_embedding_pool():
+    global embedding_pool
+
+    if embedding_pool is not None:
+        SentenceTransformer.stop_multi_process_pool(embedding_pool)
+        embedding_pool = None
+
 # API Endpoints
 @app.get("/health")
 async def health_check():
@@ -101,22 +620,25 @@ async def upload_and_process_document(file: UploadFile = File(...)):
     try:
         # Use a temporary directory that works on Windows/Linux
         # Create a temp file to save the uploaded content
+        fd, file_location = tempfile.mkstemp(suffix=f"_{file.filename}")
+        os.close(fd)
         try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{file.filename}") as tmp:
-                shutil.copyfileobj(file.file, tmp)
-                file_location = tmp.name
+            # Stream the upload in 1 MiB chunks so the event loop isn't blocked
+            async with aiofiles.open(file_location, 'wb') as out:
+                while chunk := await file.read(1 << 20):
+                    await out.write(chunk)
         except Exception as e:
+             os.remove(file_location)
              return {"error": f"Failed to save temp file: {e}", "status": "failed"}
 
         extracted_text = ""
         try:
             if file.filename.lower().endswith('.pdf'):
-                reader = PdfReader(file_location)
-                for page in reader.pages:
-                    extracted_text += page.extract_text() or ""
+                # PDF parsing is CPU-bound, keep it off the event loop
+                extracted_text = await asyncio.to_thread(_extract_pdf_text, file_location)
             elif file.filename.lower().endswith(('.txt')):
-                with open(file_location, 'r', encoding='utf-8') as f:
-                    extracted_text = f.read()
+                async with aiofiles.open(file_location, 'r', encoding='utf-8') as f:
+                    extracted_text = await f.read()
             else:
                 return {"error": "Unsupported file type. Please upload PDF or TXT.", "status": "failed"}
         finally:
@@ -138,41 +660,53 @@ async def upload_and_process_document(file: UploadFile = File(...)):
 
 @app.post("/generate-and-store-embedding/")
 async def generate_and_store_embedding(chunk: TextChunk):
-    global faiss_index, vector_store_texts, vector_store_metadata
+    global faiss_index, vector_store_size, vector_store_texts, vector_store_metadata
 
     try:
-        embedding = embedding_model.encode(chunk.text, convert_to_tensor=False)
+        embedding = await embedder.embed(chunk.text)
     except Exception as e:
         return {"message": f"Error generating embedding: {e}", "status": "failed"}
 
-    faiss_index.add(np.array([embedding]))
-    vector_store_texts.append(chunk.text)
-    vector_store_metadata.append(chunk.metadata)
+    np.copyto(_STAGE1[0], embedding)
+    faiss.normalize_L2(_STAGE1)
+    _STAGE1_ID[0] = vector_store_size
+    faiss_index.add_with_ids(_STAGE1, _STAGE1_ID)
+    _store_append([chunk.text], [chunk.metadata])
 
     return {"message": "Embedding generated and stored successfully.", "index_size": faiss_index.ntotal, "status": "success"}
 
 @app.post("/search-vectors/")
 async def search_vectors(query_data: SearchQuery):
-    global faiss_index, vector_store_texts, vector_store_metadata
+    global faiss_index, vector_store_size, vector_store_texts, vector_store_metadata
 
     if faiss_index.ntotal == 0:
         return {"message": "No vectors in the database to search.", "results": [], "status": "failed"}
 
     try:
-        query_embedding = embedding_model.encode(query_data.query, convert_to_tensor=False)
+        query_embedding = await embedder.embed(query_data.query)
     except Exception as e:
         return {"message": f"Error generating query embedding: {e}", "results": [], "status": "failed"}
 
-    distances, indices = faiss_index.search(np.array([query_embedding]), query_data.k)
-
-    results = []
-    for i, idx in enumerate(indices[0]):
-        if idx < len(vector_store_texts):
-            results.append({
-                "text": vector_store_texts[idx],
-                "metadata": vector_store_metadata[idx],
-                "distance": float(distances[0][i])
-            })
+    np.copyto(_QUERY_STAGE1[0], query_embedding)
+    faiss.normalize_L2(_QUERY_STAGE1)
+    similarities, indices = faiss_index.search(_QUERY_STAGE1, query_data.k)
+
+    # FAISS pads with -1 (and -FLT_MAX similarity) when fewer than k vectors are found
+    idxs = indices[0]
+    valid = (idxs >= 0) & (idxs < vector_store_size)
+    idxs = idxs[valid]
+    # Report squared L2 distance as before: for unit vectors ||a - b||^2 = 2 - 2<a, b>.
+    # Clamp at 0, since fp16 rounding can push a near-exact match's similarity above 1.
+    dists = np.maximum(2.0 - 2.0 * similarities[0][valid], 0.0)
+    # tolist() converts each column to Python objects in one C call
+    results = [
+        {"text": text, "metadata": metadata, "distance": distance}
+        for text, metadata, distance in zip(
+            vector_store_texts[idxs].tolist(),
+            vector_store_metadata[idxs].tolist(),
+            dists.tolist()
+        )
+    ]
 
     return {"message": "Search completed successfully.", "results": results, "status": "success"}
 
@@ -188,7 +722,7 @@ async def chat_with_ai(request: ChatRequest):
             messages.extend(request.history)
             messages.append({"role": "user", "content": request.message})
 
-            response = openai.ChatCompletion.create(
+            response = await _get_openai_client().chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=messages,
                 max_tokens=2000,
@@ -218,7 +752,8 @@ async def chat_with_ai(request: ChatRequest):
                     full_prompt += f"Assistant: {msg['content']}\n"
             full_prompt += f"User: {request.message}\nAssistant:"
             
-            response = chat.send_message(full_prompt)
+            # The Gemini SDK is synchronous; run it off the event loop
+            response = await asyncio.to_thread(chat.send_message, full_prompt)
             ai_response = response.text
 
         else:
@@ -230,10 +765,32 @@ async def chat_with_ai(request: ChatRequest):
         return {"error": str(e), "status": "failed"}
 
 
+@app.post("/persist/")
+async def persist_vector_store():
+    try:
+        _save_vector_store()
+    except Exception as e:
+        return {"message": f"Error saving vector store: {e}", "status": "failed"}
+    return {"message": f"Vector store saved to {VECTOR_STORE_PATH}.", "total_vectors": faiss_index.ntotal, "status": "success"}
+
+
 # Ingestion of dpdp_act.pdf
+# Ingests run one at a time, so two concurrent calls can't both pass the
+# already-ingested check while encoding off the event loop
+_ingest_lock = None
+
 @app.post("/ingest-dpdp-act/")
 async def ingest_dpdp_act():
-    global faiss_index, vector_store_texts, vector_store_metadata
+    global _ingest_lock
+
+    # Created lazily so it binds to the server's event loop
+    if _ingest_lock is None:
+        _ingest_lock = asyncio.Lock()
+    async with _ingest_lock:
+        return await _ingest_dpdp_act()
+
+async def _ingest_dpdp_act():
+    global faiss_index, vector_store_size, vector_store_texts, vector_store_metadata
     
     # Robust path finding
     document_path = os.path.join(os.getcwd(), 'dpdp_act.pdf')
@@ -244,26 +801,54 @@ async def ingest_dpdp_act():
         else:
              return {"message": f"File not found at {document_path}. Please place 'dpdp_act.pdf' in the backend directory.", "status": "failed"}
 
-    act_chunks = get_pdf_text_and_chunk(document_path, chunk_size=500, overlap=50)
+    abs_path = os.path.abspath(document_path)
+    path_key = (abs_path, os.path.getmtime(abs_path), os.path.getsize(abs_path))
+
+    # Ingest is idempotent: the store already holds this document's chunks
+    document_name = os.path.basename(abs_path)
+    if document_name in ingested_documents:
+        if ingested_documents[document_name] in (None, path_key):
+            return {"message": f"{document_name} is already ingested.", "total_vectors": faiss_index.ntotal, "status": "success"}
+        # The HNSW index can't remove vectors, so old rows can't be replaced in place
+        return {
+            "message": f"A different version of {document_name} is already in the vector store. "
+                       f"Delete {VECTOR_INDEX_FILE} and {VECTOR_META_FILE} and restart to re-ingest it.",
+            "status": "failed"
+        }
+
+    try:
+        act_chunks = list(_chunk_pdf(path_key, chunk_size=500, overlap=50))
+    except ValueError:
+        act_chunks = []
 
     if not act_chunks:
         return {"message": "Failed to extract or chunk DPDP Act PDF.", "status": "failed"}
 
-    successful_ingestions = 0
-    for i, chunk_data in enumerate(act_chunks):
-        chunk_text = chunk_data['text']
-        chunk_metadata = chunk_data['metadata']
+    texts = [c['text'] for c in act_chunks]
 
-        try:
-            embedding = embedding_model.encode(chunk_text, convert_to_tensor=False)
-            faiss_index.add(np.array([embedding]))
-            vector_store_texts.append(chunk_text)
-            vector_store_metadata.append(chunk_metadata)
-            successful_ingestions += 1
-        except Exception as e:
-            print(f"Error generating embedding for chunk {i} from {document_path}: {e}")
+    # Encode all (uncached) chunks in one call so SentenceTransformer can batch
+    # the forward passes, then add them to the index in a single block.
+    # Encoding (and starting the encode pool) runs off the event loop.
+    try:
+        embeddings = await asyncio.to_thread(_encode_batch, texts)
+    except Exception as e:
+        print(f"Error generating embeddings for chunks from {document_path}: {e}")
+        return {"message": f"Error generating embeddings: {e}", "status": "failed"}
+
+    # Faiss needs a C-contiguous float32 block (no copy if it already is one)
+    emb_buf = np.ascontiguousarray(embeddings, dtype=np.float32)
+    faiss.normalize_L2(emb_buf)
+    ids = np.arange(vector_store_size, vector_store_size + len(emb_buf), dtype=np.int64)
+    faiss_index.add_with_ids(emb_buf, ids)
+    _store_append(texts, [c['metadata'] for c in act_chunks])
+    ingested_documents[document_name] = path_key
+
+    try:
+        _save_vector_store()
+    except Exception as e:
+        print(f"Error saving vector store to {VECTOR_STORE_PATH}: {e}")
 
-    return {"message": f"Finished ingesting {successful_ingestions} successful chunks from {document_path}.", "total_vectors": faiss_index.ntotal, "status": "success"}
+    return {"message": f"Finished ingesting {len(texts)} successful chunks from {document_path}.", "total_vectors": faiss_index.ntotal, "status": "success"}
 
 if __name__ == "__main__":
     import uvicorn
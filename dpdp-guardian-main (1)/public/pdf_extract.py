@@ -0,0 +1,15 @@
+# Standalone PDF page-range text extractor.
+# Run as a separate process by backend.py to extract large PDFs in parallel.
+# It deliberately imports only PyPDF2, so worker processes don't load the
+# embedding model or anything else from the backend.
+import sys
+from PyPDF2 import PdfReader
+
+def extract_page_range(pdf_path, start, stop):
+    reader = PdfReader(pdf_path)
+    return "".join(reader.pages[i].extract_text() or "" for i in range(start, stop))
+
+if __name__ == "__main__":
+    # Usage: python pdf_extract.py <pdf_path> <start_page> <stop_page>
+    pdf_path, start, stop = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+    sys.stdout.buffer.write(extract_page_range(pdf_path, start, stop).encode('utf-8'))